@@ -16,6 +16,7 @@
 import re, markdown
 
 Element = markdown.util.etree.Element
+SubElement = markdown.util.etree.SubElement
 AtomicString = markdown.util.AtomicString
 tostring = markdown.util.etree.tostring
 
@@ -34,18 +35,44 @@ INLINEMATH_RE = MATH_DEL + r'(.*?)' + MATH_DEL
 class ASCIIMathMLExtension(markdown.extensions.Extension):
     def __init__(self, configs, **kwargs):
         self.config = {'level_num'  : [1, "Maximum header level to be numbered, from 0 to 6, -1 means no numbering."],
-                       'header_num' : [True, "Show number next to header."] }
+                       'header_num' : [True, "Show number next to header."],
+                       'symbols'    : [{}, "Extra symbols, mapping the input string to a MathML element or to the text of an <mo>."],
+                       'macros'     : [{}, "Macros, mapping the input string to the ASCIIMathML it stands for."],
+                       'parse_cache': [0, "Number of formula shapes to cache parse plans for, 0 disables the cache."],
+                       'max_length' : [0, "Maximum length of a formula, 0 means no limit."],
+                       'max_tokens' : [0, "Maximum number of tokens in a formula, 0 means no limit."],
+                       'max_depth'  : [0, "Maximum nesting depth of brackets in a formula, 0 means no limit."] }
         super(ASCIIMathMLExtension, self).__init__(**kwargs)
+        self.registry = SymbolRegistry(default_registry.symbols, default_registry.macros)
+        for input, el in self.getConfig('symbols').items():
+            self.registry.add_symbol(input, el)
+        for input, expansion in self.getConfig('macros').items():
+            self.registry.add_macro(input, expansion)
+        if self.getConfig('parse_cache') > 0:
+            self.parse_cache = ParsePlanCache(self.registry, self.getConfig('parse_cache'))
+        else:
+            self.parse_cache = None
+        # Number of formulas that exceeded each limit
+        self.breaches = {'length': 0, 'tokens': 0, 'depth': 0}
         self.reset()
 
     def extendMarkdown(self, md, md_globals):
         self.md = md
-        
+
+        inlineRe = INLINEMATH_RE
+        if self.getConfig('max_length') > 0:
+            # A formula within the limit is found without scanning further,
+            # a longer one is still consumed up to its closing delimiter,
+            # so that it falls back to text and the delimiters stay paired.
+            maxLength = self.getConfig('max_length')
+            inlineRe = MATH_DEL + r'(?:(.{0,%d}?)' % maxLength + MATH_DEL \
+                       + r'|(.{%d}.*?)' % (maxLength + 1) + MATH_DEL + ')'
+
         md.ESCAPED_CHARS.append('~')
         md.parser.blockprocessors.add('block_asciimath', ASCIIMathMLProcessor(md.parser, self), '>code')
         md.treeprocessors.add("eq_number", EqNumberTreeProcessor(self), '<inline')
         md.inlinePatterns.add("eq_reference", EqrefPattern(EQREF_RE, self), '<reference')
-        md.inlinePatterns.add('inline_asciimath', ASCIIMathMLPattern(INLINEMATH_RE), '>escape')
+        md.inlinePatterns.add('inline_asciimath', ASCIIMathMLPattern(inlineRe, self), '>escape')
 
     def addEqref(self, ref, num):
         if not ref in self.eqrefDict and ref != '':
@@ -56,6 +83,53 @@ class ASCIIMathMLExtension(markdown.extensions.Extension):
     def makeEqrefId(self, ref):
         return 'eq:'+ref
 
+    def checkLimits(self, *lines):
+        """ Returns the name of the first limit exceeded by the formula made
+            of lines, None if there is none.  Its length and number of tokens
+            are counted over all the lines, its depth is the one of the
+            deepest line.
+        """
+        maxTokens = self.getConfig('max_tokens')
+        maxDepth = self.getConfig('max_depth')
+
+        if 0 < self.getConfig('max_length') < sum(map(len, lines)):
+            return 'length'
+        if maxTokens > 0 or maxDepth > 0:
+            count = 0
+            for line in lines:
+                tokens = self.registry.tokenize(self.registry.expand(line).strip())
+                count += len(tokens)
+                if 0 < maxTokens < count:
+                    return 'tokens'
+                if 0 < maxDepth < self.registry.depth(tokens):
+                    return 'depth'
+        return None
+
+    def fallback(self, breach, text):
+        """ Counts the breach and returns the formula as plain text """
+        self.breaches[breach] += 1
+        return El('mtext', text)
+
+    def parseInline(self, s):
+        breach = self.checkLimits(s)
+        if breach is None:
+            try:
+                if self.parse_cache is not None:
+                    return self.parse_cache.parse(s)
+                return parse(s, registry=self.registry)
+            except RecursionError:
+                breach = 'depth'
+        return El('math', El('mstyle', self.fallback(breach, s)))
+
+    def parseBlock(self, *lines):
+        breach = self.checkLimits(*lines)
+        if breach is None:
+            try:
+                return parse_multiline(*lines, registry=self.registry)
+            except RecursionError:
+                breach = 'depth'
+        return El('mrow', self.fallback(breach, '\n'.join(lines)))
+
     def reset(self):
         self.eqrefDict = {}
         
@@ -85,7 +159,7 @@ class ASCIIMathMLProcessor(markdown.blockprocessors.BlockProcessor):
             if len(eqs) > 1 or eqs[0][0] != '':
                 eqsnode = El('mtable', columalign='left')
                 for eq in eqs:
-                    eqnode = parse_multiline(*eq[1])
+                    eqnode = self.ext.parseBlock(*eq[1])
                     if self.ext.addEqref(eq[0],''):
                         eqsnode.append( El('mtr', 
                                         El('mtd', eqnode ), 
@@ -94,7 +168,7 @@ class ASCIIMathMLProcessor(markdown.blockprocessors.BlockProcessor):
                     else:
                         eqsnode.append(El('mtr', eqnode))
             else: 
-                eqsnode = parse_multiline(*eqs[0][1])
+                eqsnode = self.ext.parseBlock(*eqs[0][1])
 
         mathml = El('math', El('mstyle', eqsnode))
         mathml.set('xmlns', 'http://www.w3.org/1998/Math/MathML')
@@ -188,8 +262,14 @@ class EqNumberTreeProcessor(markdown.treeprocessors.Treeprocessor):
 
 class ASCIIMathMLPattern(markdown.inlinepatterns.Pattern):
 
+    def __init__(self, pattern, extension):
+        super(ASCIIMathMLPattern, self).__init__(pattern)
+        self.ext = extension
+
     def handleMatch(self, m):
-        mathml = parse(m.group(3).strip())
+        # Group 5 is a formula over max_length, parseInline() falls back on it
+        formula = m.group(3) if m.group(3) is not None else m.group(5)
+        mathml = self.ext.parseInline(formula.strip())
         mathml.set('xmlns', 'http://www.w3.org/1998/Math/MathML')
         return mathml
 
@@ -198,17 +278,20 @@ def makeExtension(configs=None):
 
 # Parser #
 
-def parse_multiline(*lines) :
+def parse_multiline(*lines, registry=None) :
+    if registry is None:
+        registry = default_registry
+
     if len(lines) > 1: 
         node = El('mtable', columalign='left')
         for line in lines :
-            line, linenodes = parse_exprs(line)
+            i, linenodes = parse_exprs(registry.expand(line).rstrip(), registry=registry)
             remove_invisible(linenodes)
             linenodes = map(remove_private, linenodes)
             node.append(El('mtr', *linenodes))
         return node
     elif len(lines) == 1 :
-        line, linenodes = parse_exprs(lines[0])
+        i, linenodes = parse_exprs(registry.expand(lines[0]).rstrip(), registry=registry)
         remove_invisible(linenodes)
         linenodes = map(remove_private, linenodes)
         return El('mrow', *linenodes)
@@ -290,7 +373,7 @@ def sup(base, superscript):
 
     return n
 
-def parse(s):
+def parse(s, registry=None):
     """
 Translates from ASCIIMathML (an easy to type and highly readable way to
 represent math formulas) into MathML (a w3c standard directly displayable by
@@ -308,28 +391,142 @@ example we can generate its string representation:
     >>> from xml.etree.ElementTree import tostring
     >>> tostring(asciimathml.parse('sqrt 2'))
     '<math><mstyle><msqrt><mn>2</mn></msqrt></mstyle></math>'
+
+Symbols and macros are looked up in `registry`, a `SymbolRegistry`, which
+defaults to the built-in one.
     """
-    s, nodes = parse_exprs(s)
+    if registry is None:
+        registry = default_registry
+
+    i, nodes = parse_exprs(registry.expand(s).rstrip(), registry=registry)
     remove_invisible(nodes)
     nodes = map(remove_private, nodes)
 
     return El('math', El('mstyle', *nodes))
 
+class ParsePlanCache(object):
+    """ Caches parse trees by formula shape.
+
+        The shape of a formula is its token sequence with the numbers and
+        one letter identifiers abstracted away, so `3x^2 + 7x - 4` and
+        `5y^2 + 2y - 1` share a parse plan: a template tree plus the slots
+        where the actual values go.  `parse()` returns the same tree as the
+        module level `parse()`.
+    """
+
+    def __init__(self, registry=None, size=1024):
+        self.registry = default_registry if registry is None else registry
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._plans = {}
+        self._version = self.registry.version
+
+    def shape(self, s):
+        """ Returns (key, values) for s, or (None, None) if s can't be cached """
+        key = []
+        values = []
+        for start, token, kind in self.registry.tokenize(s):
+            if kind == 'number':
+                key.append(1 if token[0] == '-' else 0)
+                values.append(token.lstrip('-'))
+            elif kind == 'char' and token.isalpha():
+                key.append(2)
+                values.append(token)
+            else:
+                # Text isn't tokenized by the parser
+                if kind == 'symbol' and self.registry.is_text(token):
+                    return None, None
+                key.append(token)
+
+        return tuple(key), values
+
+    def parse(self, s):
+        if self._version != self.registry.version:
+            self._plans = {}
+            self._version = self.registry.version
+
+        s = self.registry.expand(s).strip()
+        key, values = self.shape(s)
+        plan = self._plans.get(key) if key is not None else None
+
+        if plan is None:
+            self.misses += 1
+            tree, plan = self._make_plan(s)
+            if key is not None and plan is not None:
+                if len(self._plans) >= self.size:
+                    self._plans.clear()
+                self._plans[key] = plan
+            return tree
+
+        self.hits += 1
+        return self._fill(plan, values)
+
+    def _make_plan(self, s):
+        i, children = parse_exprs(s, registry=self.registry)
+        remove_invisible(children)
+        tree = El('math', El('mstyle', *children))
+
+        # Token index of every literal, by its position
+        literals = {}
+        for start, token, kind in self.registry.tokenize(s):
+            if kind == 'number' or (kind == 'char' and token.isalpha()):
+                literals[start] = len(literals)
+
+        # The plan is the flattened tree, with the parent of every element
+        nodes = []
+        slots = []
+        parents = {tree: -1}
+        for i, n in enumerate(tree.iter()):
+            for c in n:
+                parents[c] = i
+            pos = n.get('_pos')
+            if pos is not None:
+                slots.append((i, literals.get(pos)))
+        remove_private(tree)
+
+        for n in tree.iter():
+            nodes.append((n.tag, dict(n.attrib), n.text, parents[n]))
+
+        # Give up if an element is shared or a literal went missing
+        if len(parents) != len(nodes) or len(slots) != len(literals) \
+           or any(j is None for i, j in slots):
+            return tree, None
+
+        return tree, (nodes, slots)
+
+    def _fill(self, plan, values):
+        nodes, slots = plan
+        texts = dict((i, AtomicString(values[j])) for i, j in slots)
+        elements = []
+        for i, (tag, attrib, text, parent) in enumerate(nodes):
+            if parent < 0:
+                n = Element(tag, attrib)
+            else:
+                n = SubElement(elements[parent], tag, attrib)
+            n.text = texts.get(i, text)
+            elements.append(n)
+        return elements[0]
+
 delimiters = {'{': '}', '(': ')', '[': ']'}
 
-def parse_string(s):
-    opening = s[0]
+def parse_string(s, i, registry=None):
+    opening = s[i]
 
     if opening in delimiters:
         closing = delimiters[opening]
-        end = s.find(closing)
+        end = s.find(closing, i)
 
-        text = s[1:end]
-        s = s[end+1:]
+        if end < 0:
+            # Unclosed, drop the last character and parse the rest again
+            text = s[i+1:-1]
+        else:
+            text = s[i+1:end]
+            i = end + 1
     else:
-        s, text = parse_m(s)
+        i, text = parse_m(s, i, registry=registry)
 
-    return s, El('mrow', El('mtext', text))
+    return i, El('mrow', El('mtext', text))
 
 tracing_level = 0
 def trace_parser(p):
@@ -338,7 +535,7 @@ def trace_parser(p):
 
     Use it to decorate functions with signature:
 
-      string -> (string, nodes)
+      (string, index) -> (index, nodes)
 
     and a trace of the progress made by the parser will be printed to stderr.
 
@@ -370,23 +567,23 @@ def trace_parser(p):
         sys.stderr.write('\n')
         sys.stderr.flush()
 
-    def wrapped(s, *args, **kwargs):
+    def wrapped(s, i, *args, **kwargs):
         global tracing_level
 
-        print_trace(p.__name__, repr(s))
+        print_trace(p.__name__, repr(s[i:]))
 
         tracing_level += 1
-        s, n = p(s, *args, **kwargs)
+        i, n = p(s, i, *args, **kwargs)
         tracing_level -= 1
 
-        print_trace("-> ", repr(s), nodes_to_string(n))
+        print_trace("-> ", repr(s[i:]), nodes_to_string(n))
 
-        return s, n
+        return i, n
 
     return wrapped
 
-def parse_expr(s, siblings, required=False):
-    s, n = parse_m(s, required=required)
+def parse_expr(s, i, siblings, required=False, registry=None):
+    i, n = parse_m(s, i, required=required, registry=registry)
 
     if not n is None:
         # Being both an _opening and a _closing element is a trait of
@@ -396,27 +593,20 @@ def parse_expr(s, siblings, required=False):
         if n.get('_opening', False) \
            and (not n.get('_closing', False) \
                 or find_node_backwards(siblings, n.text) == -1):
-            s, children = parse_exprs(s, [n], inside_parens=True)
+            i, children = parse_exprs(s, i, [n], inside_parens=True, registry=registry)
             n = El('mrow', *children)
 
         if n.tag == 'mtext':
-            s, n = parse_string(s)
+            i, n = parse_string(s, i, registry=registry)
         elif n.get('_arity', 0) == 1:
-            s, m = parse_expr(s, [], True)
+            i, m = parse_expr(s, i, [], True, registry=registry)
             n = unary(n, m, n.get('_swap', False))
         elif n.get('_arity', 0) == 2:
-            s, m1 = parse_expr(s, [], True)
-            s, m2 = parse_expr(s, [], True)
+            i, m1 = parse_expr(s, i, [], True, registry=registry)
+            i, m2 = parse_expr(s, i, [], True, registry=registry)
             n = binary(n, m1, m2, n.get('_swap', False))
 
-    return s, n
-
-def find_node(ns, text):
-    for i, n in enumerate(ns):
-        if n.text == text:
-            return i
-
-    return -1
+    return i, n
 
 def find_node_backwards(ns, text):
     for i, n in enumerate(reversed(ns)):
@@ -426,21 +616,23 @@ def find_node_backwards(ns, text):
     return -1
 
 def nodes_to_row(row):
+    """ Splits the children of a row on commas in a single pass. """
     mrow = El('mtr')
 
     nodes = row.getchildren()
-
-    while True:
-        i = find_node(nodes, ',')
-
-        if i > 0:
-            mrow.append(El('mtd', *nodes[:i]))
-
-            nodes = nodes[i+1:]
-        else:
-            mrow.append(El('mtd', *nodes))
+    start = 0
+
+    for i, n in enumerate(nodes):
+        # A comma at the start of a cell ends the splitting, the rest of the
+        # row goes in the last cell.
+        if n.text == ',' and i > start:
+            mrow.append(El('mtd', *nodes[start:i]))
+            start = i + 1
+        elif n.text == ',':
             break
 
+    mrow.append(El('mtd', *nodes[start:]))
+
     return mrow
 
 def nodes_to_matrix(nodes):
@@ -454,33 +646,34 @@ def nodes_to_matrix(nodes):
 
     return El('mrow', nodes[0], mtable, nodes[-1])
 
-def parse_exprs(s, nodes=None, inside_parens=False):
+def parse_exprs(s, i=0, nodes=None, inside_parens=False, registry=None):
     if nodes is None:
         nodes = []
 
     inside_matrix = False
 
     while True:
-        s, n = parse_expr(s, nodes)
+        i, n = parse_expr(s, i, nodes, registry=registry)
 
         if not n is None:
             nodes.append(n)
 
             if n.get('_closing', False):
                 if not inside_matrix:
-                    return s, nodes
+                    return i, nodes
                 else:
-                    return s, nodes_to_matrix(nodes)
+                    return i, nodes_to_matrix(nodes)
 
-            if inside_parens and n.text == ',' and is_enclosed_in_parens(nodes[-2]):
+            if inside_parens and not inside_matrix and n.text == ',' \
+               and is_enclosed_in_parens(nodes[-2]):
                 inside_matrix = True
 
             if len(nodes) >= 3 and nodes[-2].get('_special_binary'):
                 transform =  nodes[-2].get('_special_binary')
                 nodes[-3:] = [transform(nodes[-3], nodes[-1])]
 
-        if s == '':
-            return '', nodes
+        if i >= len(s):
+            return len(s), nodes
 
 def remove_private(n):
     _ks = [k for k in n.keys() if k.startswith('_') or k == 'attrib']
@@ -508,34 +701,335 @@ def copy(n):
 
     return m
 
-def parse_m(s, required=False):
-    s = s.strip()
+# Packed trees
+#
+# pack() turns a tree into bytes, each element in document order being
+#
+#   tag, number of children, number of attributes, (name, value)*, text
+#
+# A tag or attribute name is k + 1 for packed_names[k], or 0 followed by the
+# name itself.  Attribute values are strings, the text is 0 for None or a
+# string whose length is stored as (2 * length + atomic + 1).  Numbers are
+# varints and strings are UTF-8 preceded by their length.  Tails are not kept.
+#
+# The bytes don't depend on the process that packed them, as long as
+# packed_names is only ever appended to.
+
+packed_names = ('math', 'mstyle', 'mrow', 'mi', 'mo', 'mn', 'mtext', 'mspace',
+                'msqrt', 'mroot', 'mfrac', 'msub', 'msup', 'msubsup', 'munder',
+                'mover', 'munderover', 'mtable', 'mtr', 'mtd',
+                'xmlns', 'display', 'columalign', 'width', 'class', 'id')
+_nameCodes = dict((name, k + 1) for k, name in enumerate(packed_names))
+
+def _write_string(out, s):
+    s = s.encode('utf-8')
+    _write_varint(out, len(s))
+    out.extend(s)
+
+def _write_name(out, name):
+    code = _nameCodes.get(name)
+    if code is None:
+        out.append(0)
+        _write_string(out, name)
+    else:
+        _write_varint(out, code)
+
+def _read_string(data, i):
+    size, i = _read_varint(data, i)
+    return data[i:i+size].decode('utf-8'), i + size
+
+def _read_name(data, i):
+    code, i = _read_varint(data, i)
+    if code:
+        return packed_names[code - 1], i
+    return _read_string(data, i)
+
+def _write_varint(out, n):
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _read_varint(data, i):
+    n = shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+def pack(tree):
+    """ Returns the bytes of tree, unpack() inflates them back in any process """
+    out = bytearray()
+
+    def pack_element(n):
+        _write_name(out, n.tag)
+        _write_varint(out, len(n))
+        # items() rather than attrib, which the C elements create on access
+        items = n.items()
+        _write_varint(out, len(items))
+        for k, v in items:
+            _write_name(out, k)
+            _write_string(out, v)
+        if n.text is None:
+            out.append(0)
+        else:
+            text = n.text.encode('utf-8')
+            _write_varint(out, 2 * len(text) + isinstance(n.text, AtomicString) + 1)
+            out.extend(text)
+        for c in n:
+            pack_element(c)
+
+    pack_element(tree)
+    return bytes(out)
+
+def unpack_elements(data):
+    """ Inflates packed bytes, returns the list of elements in document order """
+    elements = []
+    # Open elements with the number of children they still miss
+    stack = []
+    names = packed_names
+    i = 0
+    end = len(data)
+    while i < end:
+        # Almost every tag is in packed_names, skip _read_name for those
+        tag = data[i]
+        if 0 < tag < 0x80:
+            tag = names[tag - 1]
+            i += 1
+        else:
+            tag, i = _read_name(data, i)
+        children = data[i]
+        if children < 0x80:
+            i += 1
+        else:
+            children, i = _read_varint(data, i)
+        attrib = {}
+        if data[i] == 0:
+            i += 1
+        else:
+            nattrib, i = _read_varint(data, i)
+            for a in range(nattrib):
+                k, i = _read_name(data, i)
+                attrib[k], i = _read_string(data, i)
+
+        if stack:
+            parent = stack[-1]
+            n = SubElement(parent[0], tag, attrib)
+            parent[1] -= 1
+            if parent[1] == 0:
+                stack.pop()
+        else:
+            n = Element(tag, attrib)
+
+        code = data[i]
+        if code < 0x80:
+            i += 1
+        else:
+            code, i = _read_varint(data, i)
+        if code:
+            size = (code - 1) >> 1
+            text = data[i:i+size].decode('utf-8')
+            n.text = AtomicString(text) if (code - 1) & 1 else text
+            i += size
+
+        elements.append(n)
+        if children:
+            stack.append([n, children])
 
-    if s == '':
-        return '', El('mi', '\u25a1') if required else None
+    return elements
 
-    m = number_re.match(s)
+def unpack(data):
+    return unpack_elements(data)[0]
+
+space_re = re.compile(r'\s*')
+
+# Literal numbers and identifiers are marked with their position, so
+# ParsePlanCache can find them in the tree.
+def parse_m(s, i=0, required=False, registry=None):
+    if registry is None:
+        registry = default_registry
+
+    i = space_re.match(s, i).end()
+
+    if i >= len(s):
+        return len(s), El('mi', '\u25a1') if required else None
+
+    m = number_re.match(s, i)
 
     if m:
         number = m.group(0)
         if number[0] == '-':
-            return s[m.end():], El('mrow', El('mo', '-'), El('mn', number[1:]))
+            return m.end(), El('mrow', El('mo', '-'), El('mn', number[1:], _pos=i))
         else:
-            return s[m.end():], El('mn', number)
+            return m.end(), El('mn', number, _pos=i)
+
+    y = registry.match(s, i)
 
-    for y in symbol_names:
-        if s.startswith(y):
-            n = copy(symbols[y])
+    if not y is None:
+        n = copy(registry.symbols[y])
 
-            if n.get('_space', False):
-                n = El('mrow',
-                        El('mspace', width='1ex'),
-                        n,
-                        El('mspace', width='1ex'))
+        if n.get('_space', False):
+            n = El('mrow',
+                    El('mspace', width='1ex'),
+                    n,
+                    El('mspace', width='1ex'))
 
-            return s[len(y):], n
+        return i + len(y), n
+
+    if s[i].isalpha():
+        return i + 1, El('mi', s[i], _pos=i)
+    else:
+        return i + 1, El('mo', s[i])
 
-    return s[1:], El('mi' if s[0].isalpha() else 'mo', s[0])
+class SymbolRegistry(object):
+    """ Symbols and macros known to the parser.
+
+        Symbols map an input string to the element it is translated to,
+        macros map an input string to the ASCIIMathML it stands for.
+        The matchers are compiled on first use after a change, and macro
+        expansions are cached per formula.
+    """
+
+    def __init__(self, symbols=None, macros=None, cache_size=1024):
+        self.symbols = dict(symbols or {})
+        self.macros = dict(macros or {})
+        self.cache_size = cache_size
+        self.version = 0
+        self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self._symbol_re = None
+        self._macro_re = None
+        self._token_re = None
+        self._expansions = {}
+
+    def _compile(self, names):
+        # Longest names first, so the alternation matches the longest symbol
+        names = sorted(names, key=len, reverse=True)
+        return re.compile('|'.join(map(re.escape, names)))
+
+    def add_symbol(self, input, el):
+        if isinstance(el, str):
+            el = El('mo', el)
+        self.symbols[input] = el
+        self._changed()
+
+    def add_macro(self, input, expansion):
+        self.macros[input] = expansion
+        self._changed()
+
+    def match(self, s, i=0):
+        """ Returns the longest symbol at index i of s, None if there is none """
+        if self._symbol_re is None:
+            self._symbol_re = self._compile(self.symbols)
+
+        m = self._symbol_re.match(s, i)
+        return m.group(0) or None if m else None
+
+    def tokenize(self, s):
+        """ Splits s into (start, token, kind) tuples, kind being 'number',
+            'symbol', 'char' or 'text', the same way parse_m() does.  The
+            delimited text after a text symbol is a single 'text' token.
+        """
+        if self._token_re is None:
+            pattern = r'\s*(?:(?P<number>' + number_re.pattern + ')'
+            if self.symbols:
+                names = sorted(self.symbols, key=len, reverse=True)
+                pattern += '|(?P<symbol>' + '|'.join(map(re.escape, names)) + ')'
+            pattern += '|(?P<char>.))'
+            self._token_re = re.compile(pattern, re.S)
+
+        tokens = []
+        i = 0
+        m = self._token_re.match(s)
+        while m is not None:
+            kind = m.lastgroup
+            tokens.append((m.start(kind), m.group(kind), kind))
+            i = m.end()
+            if kind == 'symbol' and self.is_text(m.group(kind)):
+                end = self.text_end(s, i)
+                if end > i:
+                    tokens.append((i, s[i:end], 'text'))
+                    i = end
+            m = self._token_re.match(s, i)
+
+        return tokens
+
+    def is_text(self, name):
+        """ Tells whether the parser reads the symbol name as text, whose
+            contents aren't tokenized.
+        """
+        el = self.symbols.get(name)
+        return el is not None and el.tag == 'mtext' and not el.get('_space', False)
+
+    def text_end(self, s, i):
+        """ Returns the index just after the delimited text at index i of s,
+            read after a text symbol, or i if there is none.  An unclosed
+            delimiter doesn't start a text, like in parse_string().
+        """
+        if i < len(s) and s[i] in delimiters:
+            end = s.find(delimiters[s[i]], i)
+            if end >= 0:
+                return end + 1
+        return i
+
+    def depth(self, tokens):
+        """ Returns the maximum nesting depth of brackets among tokens """
+        depth = maxDepth = 0
+        for start, token, kind in tokens:
+            if kind != 'symbol':
+                continue
+            el = self.symbols[token]
+            # Symmetrical delimiters (e.g. ||) can't be told apart here
+            if el.get('_opening', False) and not el.get('_closing', False):
+                depth += 1
+                maxDepth = max(depth, maxDepth)
+            elif el.get('_closing', False) and not el.get('_opening', False):
+                depth = max(depth - 1, 0)
+        return maxDepth
+
+    def expand(self, s):
+        """ Returns s with its macros expanded """
+        if not self.macros:
+            return s
+
+        if s in self._expansions:
+            return self._expansions[s]
+
+        if self._macro_re is None:
+            # Symbols are matched too, so that a macro is expanded only
+            # when it is the longest token at its position.
+            self._macro_re = self._compile(list(self.symbols) + list(self.macros))
+
+        parts = []
+        i = 0
+        m = self._macro_re.search(s)
+        while m is not None:
+            name = m.group(0)
+            parts.append(s[i:m.start()])
+            i = m.end()
+            if name in self.macros:
+                parts.append(self.macros[name])
+            else:
+                parts.append(name)
+                # Keep the text of text(...) as it is, like parse_string()
+                if self.is_text(name):
+                    end = self.text_end(s, i)
+                    parts.append(s[i:end])
+                    i = end
+            m = self._macro_re.search(s, i)
+        parts.append(s[i:])
+        expanded = ''.join(parts)
+
+        if len(self._expansions) >= self.cache_size:
+            self._expansions.clear()
+        self._expansions[s] = expanded
+
+        return expanded
 
 symbols = {}
 
@@ -742,4 +1236,4 @@ Symbol(input="text", el=El("mtext", _arity=1))
 # {input:"mbox", tag:"mtext", output:"mbox", tex:null, ttype:TEXT},
 # {input:"\"",   tag:"mtext", output:"mbox", tex:null, ttype:TEXT};
 
-symbol_names = sorted(symbols.keys(), key=lambda s: len(s), reverse=True)
+default_registry = SymbolRegistry(symbols)
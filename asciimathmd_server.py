@@ -0,0 +1,334 @@
+#    Copyright (c) 2014, Davide Poderini
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Long lived render server for asciimathmd.
+
+Keeps the interpreter, Markdown and the parser caches warm and serves render
+requests over a Unix socket or over stdin/stdout:
+
+    python -m asciimathmd_server --socket /tmp/asciimathmd.sock --workers 4
+    python -m asciimathmd_server --stdio
+
+Every message, both ways, is a frame: a 4 byte big-endian length followed by
+that many bytes of UTF-8 JSON.  Requests are
+
+    {"type": "formula", "text": "x^2", "display": "inline"}
+    {"type": "markdown", "text": "Some ~x^2~ markdown"}
+
+("display" can also be "block") and responses are
+
+    {"ok": true, "result": "<math ...>...</math>"}
+    {"ok": false, "error": "..."}
+
+Responses come back in the same order as the requests on each connection.
+A frame that can't be decoded, or that is longer than MAX_FRAME, gets an
+error response; only a truncated frame ends the connection.
+"""
+
+import json, os, re, signal, socket, socketserver, stat, struct, subprocess, sys, threading
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+
+import markdown
+import asciimathmd
+
+HEADER = struct.Struct('>I')
+MAX_FRAME = 64 * 1024 * 1024
+
+class FrameError(ValueError):
+    """ A frame was read whole but can't be used """
+    pass
+
+def read_frame(f, maxSize=MAX_FRAME):
+    """ Reads a frame from the binary file f, None at the end of the stream.
+
+        Raises EOFError if the stream ends inside a frame, and FrameError if
+        the frame is too long or isn't a UTF-8 JSON object, in which case it has been
+        skipped and the next frame can still be read.
+    """
+    header = f.read(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        raise EOFError('truncated frame header')
+
+    size, = HEADER.unpack(header)
+    if size > maxSize:
+        # Skip the body without holding it in memory
+        left = size
+        while left > 0:
+            chunk = f.read(min(left, 1 << 16))
+            if not chunk:
+                raise EOFError('truncated frame')
+            left -= len(chunk)
+        raise FrameError('frame of %d bytes is longer than %d' % (size, maxSize))
+
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError('truncated frame')
+
+    try:
+        obj = json.loads(data.decode('utf-8'))
+    except ValueError as e:
+        raise FrameError('invalid frame: %s' % e)
+    if not isinstance(obj, dict):
+        raise FrameError('frame is not a JSON object')
+
+    return obj
+
+def write_frame(f, obj):
+    data = json.dumps(obj).encode('utf-8')
+    f.write(HEADER.pack(len(data)) + data)
+    f.flush()
+
+class RenderError(Exception):
+    pass
+
+class Renderer(object):
+    """ Renders formulas and Markdown documents with a single extension
+        instance, so its registry and caches stay warm between requests.
+    """
+
+    def __init__(self, configs=None, cache_size=4096):
+        self.configs = dict(configs or {})
+        self.ext = asciimathmd.ASCIIMathMLExtension(None, **self.configs)
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def render(self, request):
+        kind = request.get('type')
+        text = request.get('text', '')
+
+        if kind == 'formula':
+            key = (request.get('display', 'inline'), text)
+            if key not in self.cache:
+                if len(self.cache) >= self.cache_size:
+                    self.cache.clear()
+                self.cache[key] = self.renderFormula(text, key[0])
+            return self.cache[key]
+        elif kind == 'markdown':
+            return self.renderMarkdown(text)
+        else:
+            raise RenderError('unknown request type %r' % kind)
+
+    def renderFormula(self, text, display='inline'):
+        if display == 'block':
+            mathml = asciimathmd.El('math', asciimathmd.El('mstyle',
+                        self.ext.parseBlock(*re.split(asciimathmd.LINEBREAK_RE, text))))
+            mathml.set('display', 'block')
+        elif display == 'inline':
+            mathml = self.ext.parseInline(text.strip())
+        else:
+            raise RenderError('unknown display %r' % display)
+
+        mathml.set('xmlns', 'http://www.w3.org/1998/Math/MathML')
+        return asciimathmd.tostring(mathml, encoding='unicode')
+
+    def renderMarkdown(self, text):
+        # Equation numbers and references are per document, so each one gets
+        # its own extension, sharing the registry and caches of self.ext
+        ext = asciimathmd.ASCIIMathMLExtension(None, **self.configs)
+        ext.registry = self.ext.registry
+        ext.parse_cache = self.ext.parse_cache
+        ext.breaches = self.ext.breaches
+        md = markdown.Markdown(extensions=[ext])
+        return md.convert(text)
+
+def error_response(e):
+    return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+
+def respond(render):
+    """ Returns the response frame for the result of render() """
+    try:
+        return {'ok': True, 'result': render()}
+    except Exception as e:
+        return error_response(e)
+
+# Worker processes keep their own renderer
+_renderer = None
+
+def _init_worker(configs):
+    global _renderer
+    _renderer = Renderer(configs)
+
+def _render(request):
+    return _renderer.render(request)
+
+class Server(object):
+    """ Dispatches requests to a pool of worker processes, or renders them
+        in process when workers is 0.
+    """
+
+    def __init__(self, workers=0, configs=None):
+        if workers > 0:
+            self.pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                            initargs=(configs or {},))
+            self.renderer = None
+        else:
+            self.pool = None
+            self.renderer = Renderer(configs)
+            # Connections are served by their own threads, one at a time
+            # may use the renderer
+            self.lock = threading.Lock()
+
+    def render(self, request):
+        with self.lock:
+            return self.renderer.render(request)
+
+    def submit(self, request):
+        """ Returns a callable that waits for the response to request """
+        if self.pool is None:
+            return lambda: respond(lambda: self.render(request))
+
+        future = self.pool.submit(_render, request)
+        return lambda: respond(future.result)
+
+    def serve(self, rfile, wfile):
+        """ Serves the frames read from rfile until it ends.
+
+            Requests are handed to the pool as soon as they are read, while
+            a writer thread sends the responses back in order.
+        """
+        pending = Queue()
+
+        def writer():
+            while True:
+                result = pending.get()
+                if result is None:
+                    break
+                write_frame(wfile, result())
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            while True:
+                try:
+                    request = read_frame(rfile)
+                except FrameError as e:
+                    pending.put(lambda e=e: error_response(e))
+                    continue
+                except EOFError:
+                    break
+                if request is None:
+                    break
+                pending.put(self.submit(request))
+        finally:
+            pending.put(None)
+            thread.join()
+
+    def serveUnix(self, path):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.serve(self.rfile, self.wfile)
+
+        # Replace a stale socket, but nothing else
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as unixServer:
+            try:
+                unixServer.serve_forever()
+            finally:
+                os.unlink(path)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+class Client(object):
+    """ Sends render requests to a server, either over its Unix socket or,
+        with Client.spawn(), over the pipes of a child process.
+    """
+
+    def __init__(self, path=None, rfile=None, wfile=None):
+        self.sock = None
+        self.process = None
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+            rfile = self.sock.makefile('rb')
+            wfile = self.sock.makefile('wb')
+        self.rfile = rfile
+        self.wfile = wfile
+
+    @classmethod
+    def spawn(cls, *args):
+        """ Starts a server on stdin/stdout, args are passed to its command line """
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--stdio'] + list(args),
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        client = cls(rfile=process.stdout, wfile=process.stdin)
+        client.process = process
+        return client
+
+    def request(self, request):
+        write_frame(self.wfile, request)
+        response = read_frame(self.rfile)
+        if response is None:
+            raise RenderError('server closed the connection')
+        if not response['ok']:
+            raise RenderError(response['error'])
+        return response['result']
+
+    def renderFormula(self, text, display='inline'):
+        return self.request({'type': 'formula', 'text': text, 'display': display})
+
+    def renderMarkdown(self, text):
+        return self.request({'type': 'markdown', 'text': text})
+
+    def close(self):
+        self.wfile.close()
+        self.rfile.close()
+        if self.sock is not None:
+            self.sock.close()
+        if self.process is not None:
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serves asciimathmd render requests.")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument('--socket', help="path of the Unix socket to listen on")
+    mode.add_argument('--stdio', action='store_true', help="serve a single client on stdin/stdout")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of worker processes, 0 renders in the server process")
+    parser.add_argument('--config', default='{}',
+                        help="extension config as a JSON object, e.g. '{\"parse_cache\": 1024}'")
+    args = parser.parse_args(argv)
+
+    server = Server(args.workers, json.loads(args.config))
+    # Clean up the socket and the workers on a plain kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.stdio:
+            server.serve(sys.stdin.buffer, sys.stdout.buffer)
+        else:
+            server.serveUnix(args.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main()
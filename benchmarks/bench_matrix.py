@@ -0,0 +1,30 @@
+""" Times the parsing of large matrix literals like [(a,b,c),(d,e,f),...]
+
+Run it from the repository root:
+
+    python benchmarks/bench_matrix.py
+"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import asciimathmd
+
+SIZES = (10, 100, 300)
+
+def matrix_literal(n):
+    rows = []
+    for i in range(n):
+        rows.append('(' + ','.join('a_%d' % ((i * j) % 10) for j in range(n)) + ')')
+    return '[' + ','.join(rows) + ']'
+
+def main():
+    for n in SIZES:
+        s = matrix_literal(n)
+        repeat = 20 if n <= 10 else 1
+        t = timeit.timeit(lambda: asciimathmd.parse(s), number=repeat) / repeat
+        print('%3dx%-3d  %7d chars  %10.4f s' % (n, n, len(s), t))
+
+if __name__ == '__main__':
+    main()
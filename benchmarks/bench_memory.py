@@ -0,0 +1,70 @@
+""" Measures the memory taken by cached formulas with tracemalloc
+
+Compares element trees, as returned by parse(), with their serialized
+string and with the bytes from pack().  Run it from the repository root:
+
+    python benchmarks/bench_memory.py
+"""
+
+import gc, os, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import asciimathmd
+from asciimathmd import El, tostring
+from bench_parse_cache import exercises
+
+BLOCKS = [
+    ['e^(ix) = cos(x) + i sin(x)', 'cos(x) = (e^(ix) + e^(-ix))/2', 'sin(x) = (e^(ix) - e^(-ix))/(2i)'],
+    ['f(x) = sum_(n=0)^oo (f^((n))(a))/(n!) (x-a)^n'],
+    ['[(a,b),(c,d)]^(-1) = 1/(ad - bc) [(d,-b),(-c,a)]'],
+]
+
+def numbered_block(lines, n):
+    """ A numbered equation, wrapped like ASCIIMathMLProcessor does """
+    mathml = El('math', El('mstyle', El('mtable',
+                El('mtr',
+                    El('mtd', asciimathmd.parse_multiline(*lines)),
+                    El('mtd', El('mtext', "(%d)" % n, attrib={'class': 'eqnum'}), columalign='right'),
+                    attrib={'id': 'eq:%d' % n, 'class': 'equation'}),
+                columalign='left')))
+    mathml.set('display', 'block')
+    return mathml
+
+def corpus(n):
+    formulas = []
+    for i, s in enumerate(exercises(n)):
+        if i % 10 == 0:
+            formulas.append(numbered_block(BLOCKS[i % len(BLOCKS)], i))
+        else:
+            formulas.append(asciimathmd.parse(s))
+        formulas[-1].set('xmlns', 'http://www.w3.org/1998/Math/MathML')
+    return formulas
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def main(n=5000):
+    trees, treeBytes = measure(lambda: corpus(n))
+    strings, stringBytes = measure(lambda: [tostring(t, encoding='unicode') for t in trees])
+
+    packed, packedBytes = measure(lambda: [asciimathmd.pack(t) for t in trees])
+    del trees
+    t = time.perf_counter()
+    for data in packed:
+        asciimathmd.unpack(data)
+    t_unpack = time.perf_counter() - t
+
+    print('%d formulas' % n)
+    print('element trees   %8.0f bytes/formula' % (treeBytes / n))
+    print('MathML strings  %8.0f bytes/formula' % (stringBytes / n))
+    print('packed bytes    %8.0f bytes/formula  (%.1f us to unpack)' % (packedBytes / n, 1e6 * t_unpack / n))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+""" Compares parse() with ParsePlanCache.parse() on a generated exercise set
+
+Run it from the repository root:
+
+    python benchmarks/bench_parse_cache.py
+"""
+
+import os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import asciimathmd
+
+TEMPLATES = [
+    '{a}{x}^2 + {b}{x} - {c} = 0',
+    '({a}{x} + {b})/({c}{x} - {d}) = {e}',
+    'sum_({i}={a})^{b} {i}^{c}',
+    'int_{a}^{b} {x}^{c} d{x}',
+    'sqrt({a}{x}^2 + {b}) >= {c}',
+    '[({a},{b}),({c},{d})] [({x}),({y})]',
+    '{x}_{i} = -{a}.{b} {y}_{i} + {c}',
+]
+
+def exercises(n, seed=0):
+    rnd = random.Random(seed)
+    letters = 'abcnpqrstuvwxyz'
+    for i in range(n):
+        yield rnd.choice(TEMPLATES).format(
+            a=rnd.randint(1, 99), b=rnd.randint(1, 99), c=rnd.randint(1, 9),
+            d=rnd.randint(1, 99), e=rnd.randint(1, 9),
+            x=rnd.choice(letters), y=rnd.choice(letters), i=rnd.choice('ijk'))
+
+def main(n=20000):
+    corpus = list(exercises(n))
+
+    t = time.perf_counter()
+    fresh = [asciimathmd.parse(s) for s in corpus]
+    t_parse = time.perf_counter() - t
+
+    cache = asciimathmd.ParsePlanCache()
+    t = time.perf_counter()
+    cached = [cache.parse(s) for s in corpus]
+    t_cache = time.perf_counter() - t
+
+    for a, b in zip(fresh, cached):
+        assert asciimathmd.tostring(a) == asciimathmd.tostring(b)
+
+    print('%d formulas, %d shapes' % (n, cache.misses))
+    print('parse()            %8.3f s' % t_parse)
+    print('ParsePlanCache     %8.3f s  (%.1fx)' % (t_cache, t_parse / t_cache))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+""" Compares one process per page with a single stdio render server
+
+Run it from the repository root:
+
+    python benchmarks/bench_server.py
+"""
+
+import os, subprocess, sys, time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import asciimathmd_server
+
+PAGE = """Quadratics
+==========
+
+The roots of ~%(a)dx^2 + %(b)dx + %(c)d = 0~ are
+
+[~roots%(n)d] x_(1,2) = (-%(b)d +- sqrt(%(b)d^2 - 4 * %(a)d * %(c)d))/(2 * %(a)d)
+
+as in [~roots%(n)d], and ~sum_(i=1)^%(c)d i^2 = (%(c)d(%(c)d+1)(2 * %(c)d+1))/6~.
+"""
+
+ONE_SHOT = """
+import sys, markdown, asciimathmd
+ext = asciimathmd.ASCIIMathMLExtension(None)
+sys.stdout.write(markdown.Markdown(extensions=[ext]).convert(sys.stdin.read()))
+"""
+
+def pages(n):
+    for i in range(n):
+        yield PAGE % {'a': i % 7 + 1, 'b': i % 11 + 2, 'c': i % 5 + 1, 'n': i}
+
+def main(n=50):
+    corpus = list(pages(n))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+
+    t = time.perf_counter()
+    for page in corpus:
+        subprocess.run([sys.executable, '-c', ONE_SHOT], input=page.encode('utf-8'),
+                       stdout=subprocess.PIPE, env=env, check=True)
+    t_process = time.perf_counter() - t
+
+    t = time.perf_counter()
+    with asciimathmd_server.Client.spawn() as client:
+        # The first request waits for the server to start
+        client.renderFormula('x')
+        t_start = time.perf_counter() - t
+        for page in corpus:
+            client.renderMarkdown(page)
+    t_server = time.perf_counter() - t
+
+    print('%d pages' % n)
+    print('process per page   %8.3f s  %8.2f ms/page' % (t_process, 1000 * t_process / n))
+    print('render server      %8.3f s  %8.2f ms/page  (%.3f s startup)'
+          % (t_server, 1000 * (t_server - t_start) / n, t_start))
+
+if __name__ == '__main__':
+    main()
@@ -16,7 +16,7 @@
 from distutils.core import setup
 setup(
     name = "asciimathmd",
-    py_modules = ["asciimathmd"],
+    py_modules = ["asciimathmd", "asciimathmd_server"],
     version = "0.1",
     description = "ASCIIMathML Extension for Python Markdown",
     author = "Davide Poderini",